@@ -0,0 +1,137 @@
+# cython: language_level=2, boundscheck=False, wraparound=False, cdivision=True
+"""
+Optional compiled kernel for the PMD score computation in pmdtools.py
+
+Build it next to pmdtools.py with:	cythonize -i pmdkernels.pyx
+pmdtools.py falls back to its pure Python scoring loop when the module is not available.
+
+Scorer.score() computes exactly what the pure Python score_read() computes when neither
+--adjustbaseq, --adjustbaseq_all nor --deamination is given.
+"""
+
+from libc.math cimport log
+from libc.stdlib cimport malloc, free
+
+
+cdef inline double L_match(double P_damage, double P_error, double P_poly):
+	###(1-d)(1-e)(1-p) + d*e*(1-p) + e*p*(1-d), factored around the error probability e
+	return (1.0-P_damage)*(1.0-P_poly) - P_error*(1.0 - 2.0*(P_damage+P_poly) + 3.0*P_damage*P_poly)
+
+
+cdef class Scorer:
+	cdef double *ancient_model
+	cdef int nmodel
+	cdef double *phred2prob_div3
+	cdef int nphred
+	cdef double modern_deam
+	cdef double poly_ancient
+	cdef double poly_contamination
+	cdef int baseq
+	cdef bint cpg
+
+	def __cinit__(self, ancient_model, phred2prob_div3, double modern_deam, double poly_ancient, double poly_contamination, int baseq, bint cpg):
+		cdef int k
+		self.nmodel = len(ancient_model)
+		self.nphred = len(phred2prob_div3)
+		self.ancient_model = <double *>malloc(self.nmodel*sizeof(double))
+		self.phred2prob_div3 = <double *>malloc(self.nphred*sizeof(double))
+		if self.ancient_model == NULL or self.phred2prob_div3 == NULL:
+			raise MemoryError()
+		for k in range(self.nmodel):
+			self.ancient_model[k] = ancient_model[k]
+		for k in range(self.nphred):
+			self.phred2prob_div3[k] = phred2prob_div3[k]
+		self.modern_deam = modern_deam
+		self.poly_ancient = poly_ancient
+		self.poly_contamination = poly_contamination
+		self.baseq = baseq
+		self.cpg = cpg
+
+	def __dealloc__(self):
+		free(self.ancient_model)
+		free(self.phred2prob_div3)
+
+	cdef inline double P_error(self, const unsigned char *quals, Py_ssize_t nquals, Py_ssize_t position) except -1.0:
+		cdef int phred
+		if position >= nquals:
+			raise IndexError('quality string shorter than the read')
+		phred = quals[position]-33
+		if phred < 0:
+			phred = 0
+		if phred >= self.nphred:
+			raise IndexError('base quality out of range')
+		return self.phred2prob_div3[phred]
+
+	cdef inline double P_damage(self, Py_ssize_t position) except -1.0:
+		if position >= self.nmodel:
+			raise IndexError('read longer than the damage model')
+		return self.ancient_model[position]
+
+	def score(self, bytes real_read, bytes real_ref_seq, bytearray quals, Py_ssize_t readlen):
+		"""
+		returns log(L_D), log(L_M) for the read, see score_read() in pmdtools.py
+		"""
+		cdef const unsigned char *a_seq = real_read
+		cdef const unsigned char *b_seq = real_ref_seq
+		cdef const unsigned char *q_seq = quals
+		cdef Py_ssize_t nread = len(real_read)
+		cdef Py_ssize_t nquals = len(quals)
+		cdef Py_ssize_t n = min(nread, len(real_ref_seq))
+		cdef Py_ssize_t back_start_position = nread-1
+		cdef Py_ssize_t i, z, k
+		cdef unsigned char a, b
+		cdef int phred
+		cdef double P_error, P_match
+		cdef double log_L_D = 0.0
+		cdef double log_L_M = 0.0
+
+		for i in range(n):
+			a = a_seq[i]
+			b = b_seq[i]
+			if a == 'N' or b == 'N': continue
+			z = back_start_position - i
+			if i >= readlen: break
+
+			if i >= nquals:
+				raise IndexError('quality string shorter than the read')
+			phred = q_seq[i]-33
+			if phred < 0:
+				phred = 0
+			if phred < self.baseq: continue
+
+			if b == 'C':
+				if self.cpg:
+					if i+1 >= readlen: break
+					if i+1 >= nread:
+						raise IndexError('read shorter than its recorded length')
+					if a_seq[i+1] != 'G': continue
+				if a == 'T':
+					P_error = self.P_error(q_seq, nquals, i)
+					log_L_D += log(1.0-L_match(self.P_damage(i), P_error, self.poly_ancient))
+					log_L_M += log(1.0-L_match(self.modern_deam, P_error, self.poly_contamination))
+				elif a == 'C':
+					P_error = self.P_error(q_seq, nquals, i)
+					log_L_D += log(L_match(self.P_damage(i), P_error, self.poly_ancient))
+					log_L_M += log(L_match(self.modern_deam, P_error, self.poly_contamination))
+
+			if b == 'G':
+				if self.cpg:
+					if i+1 >= readlen: break
+					k = z-1
+					if k < 0:
+						k += nread
+					if a_seq[k] != 'C': continue
+				if a == 'A' or a == 'G':
+					# the quality of the base at z from the 3' end, as in phredsrev[z]
+					if z >= nquals:
+						raise IndexError('quality string shorter than the read')
+					P_error = self.P_error(q_seq, nquals, nquals-1-z)
+					P_match = L_match(self.P_damage(z), P_error, self.poly_ancient)
+					if a == 'A':
+						log_L_D += log(1.0-P_match)
+						log_L_M += log(1.0-L_match(self.modern_deam, P_error, self.poly_contamination))
+					else:
+						log_L_D += log(P_match)
+						log_L_M += log(L_match(self.modern_deam, P_error, self.poly_contamination))
+
+		return log_L_D, log_L_M
@@ -20,6 +20,11 @@ Example:	#remove all sequence reads with PMD score <3
 import sys
 from optparse import OptionParser
 import math
+import string
+try:
+	import pmdkernels # optional compiled scoring kernel, see pmdkernels.pyx
+except ImportError:
+	pmdkernels = None
 
 
 usage = "usage: python %prog <SAM formatted data with MD field present from stdin> [options] "
@@ -68,17 +73,10 @@ def translate(inbase):
 	elif inbase == '-': newseq += '-'
 	return outbase
 
+COMPLEMENT_TABLE = string.maketrans('ACGTN-acgtn','TGCAN-tgcan')
+
 def revcomp(inseq):
-	inseq= inseq[::-1]
-	newseq=''
-	for inbase in inseq:
-		if inbase == 'A': newseq += 'T'
-		elif inbase == 'T': newseq += 'A'
-		elif inbase == 'G': newseq += 'C'
-		elif inbase == 'C': newseq += 'G'
-		elif inbase == 'N': newseq += 'N'	
-		elif inbase == '-': newseq += '-'
-	return newseq
+	return inseq.translate(COMPLEMENT_TABLE)[::-1]
 
 def phred2prob(Q):
 	return 10.0 ** (-Q/10.0)
@@ -87,45 +85,68 @@ def prob2phred(P):
 	return -10.0*math.log(P,10)
 
 
-def L_match(fposition,fmodel,fquals,fpoly):
-	P_damage= 	float(fmodel[fposition]) 
-	P_error= 	phred2prob( (ord(fquals[fposition])-33))/3.0
+###per-base error probability (divided by the three possible substitutions), indexed by phred score
+PHRED2PROB_DIV3 = tuple(phred2prob(q)/3.0 for q in range(128))
+
+###translation table from phred+33 encoded quality characters to phred scores
+PHRED_TABLE = ''.join(chr(max(c-33,0)) for c in range(256))
+
+
+def L_match(fposition,fmodel,fphreds,fpoly):
+	P_damage= 	fmodel[fposition]
+	P_error= 	PHRED2PROB_DIV3[fphreds[fposition]]
 	P_poly=		fpoly
-	P_match= 	(1.0-P_damage)*(1.0-P_error)*(1.0-P_poly) + (P_damage*P_error*(1.0-P_poly)) + (P_error*P_poly * (1.0-P_damage))
+	###(1-d)(1-e)(1-p) + d*e*(1-p) + e*p*(1-d), factored around the error probability e
+	P_match= 	(1.0-P_damage)*(1.0-P_poly) - P_error*(1.0 - 2.0*(P_damage+P_poly) + 3.0*P_damage*P_poly)
 
 	return P_match
 
 
-def L_mismatch(fposition,fmodel,fquals,fpoly):
-	P_damage= 	float(fmodel[fposition]) 
-	P_error= 	phred2prob( (ord(fquals[fposition])-33))/3.0
-	P_poly=		fpoly
-	P_match= 	(1.0-P_damage)*(1.0-P_error)*(1.0-P_poly) + (P_damage*P_error*(1.0-P_poly)) + (P_error*P_poly * (1.0-P_damage))
-	P_mismatch=	1.0-P_match
-	return P_mismatch
+def L_mismatch(fposition,fmodel,fphreds,fpoly):
+	return 1.0-L_match(fposition,fmodel,fphreds,fpoly)
+
+###the modern (no PMD) model has the same damage probability at every position
+MODERN_DEAM = 0.001
+
+def L_match_modern(fphred,fpoly):
+	P_error= 	PHRED2PROB_DIV3[fphred]
+	P_match= 	(1.0-MODERN_DEAM)*(1.0-fpoly) - P_error*(1.0 - 2.0*(MODERN_DEAM+fpoly) + 3.0*MODERN_DEAM*fpoly)
+	return P_match
 
-def Newbaseq(fposition,fmodel,fquals):
-	P_damage= 	float(fmodel[fposition]) 
-	P_error= 	phred2prob( (ord(fquals[fposition])-33))/3.0
+def L_mismatch_modern(fphred,fpoly):
+	return 1.0-L_match_modern(fphred,fpoly)
+
+def Newbaseq(fposition,fmodel,fphreds):
+	P_damage= 	fmodel[fposition]
+	P_error= 	PHRED2PROB_DIV3[fphreds[fposition]]
 	NewErrorP= 1.0 - ((1.0-P_damage) * (1.0-P_error))
 	return NewErrorP
 
 def geometric(pval,kval,constant):
 	return ((1.0-pval)**(kval-1))*pval + constant
 
+def parse_cigar(cigar):
+	# single pass over the cigar string, returns a list of (length,operation) tuples
+	components=[]
+	length=0
+	for c in cigar:
+		if c.isdigit():
+			length = length*10 + ord(c)-48
+		else:
+			components.append((length,c))
+			length=0
+	return components
+
 
 		
 
 maxlen=options.maxlength
  
-modern_model_deam='0.001'
-modern_model_deam=modern_model_deam.split('\n')*1000 
-modern_model_deam=[float(l) for l in modern_model_deam]
-
-ancient_model_deam=[geometric(options.PMDpparam,l,options.PMDconstant) for l in range(1,1000)]
+ancient_model_deam=tuple(geometric(options.PMDpparam,l,options.PMDconstant) for l in range(1,1000))
 
+adjustment_model_deam=None
 if options.adjustbaseq_all:
-	adjustment_model_deam=[geometric(options.PMDpparam,l,0.0) for l in range(1,1000)] ###constant is 0.0 here in contrast to the model used to compute PMD scores
+	adjustment_model_deam=tuple(geometric(options.PMDpparam,l,0.0) for l in range(1,1000)) ###constant is 0.0 here in contrast to the model used to compute PMD scores
 
 start_dict= {}
 
@@ -135,15 +156,17 @@ rev_start_count = 0
 not_counted = 0
 imperfect = 0
 
-mismatch_dict={}
+###per-position counts of the read base (indexed as in BASE_INDEX) where the reference has a C,
+###counted from the 5' end, and where the reference has a G, counted from the 3' end (the _rev table)
+BASE_INDEX={'A':0,'C':1,'G':2,'T':3}
+mismatch_counts=[[0]*4 for l in range(0,options.range)]
 
 
 import re
-cigarparser = re.compile("([0-9]*)([A-Z])")
 
 
 start_dict_rev= {}
-mismatch_dict_rev={}
+mismatch_counts_rev=[[0]*4 for l in range(0,options.range)]
 
 
 deaminationlist=[]
@@ -160,15 +183,200 @@ noquals=0
 maskings=0
 
 
+def make_scorer(deamination,cpg,adjustbaseq,adjustbaseq_all,baseq,ancient_model,adjustment_model,poly_ancient,poly_contamination,maxrange,counts,counts_rev):
+	"""
+	build the per-read scoring function once, for the options given on the command line:
+	--deamination gets a loop that only tallies base counts, otherwise the loop only computes
+	the PMD likelihoods, and both find the models and remaining options among their own variables
+	"""
+	log=math.log
+
+	def prepare_quals(quals):
+		"""
+		returns the copy of the qualities that adjustments are written to,
+		and the phred scores of the read from the 5' end and from the 3' end
+		"""
+		phreds=quals.translate(PHRED_TABLE)
+		return bytearray(quals),phreds,phreds[::-1]
+
+	def adjust_quality(newquals,position,phreds,i):
+		"""
+		write the PMD-aware quality of base i, using the damage probability at position
+		(i counted from the 5' end, or z counted from the 3' end with phreds from the 3' end)
+		"""
+		newprob= Newbaseq(position,ancient_model,phreds)
+		newphred=int(prob2phred(newprob))
+		newquals[i]=newphred+33
+
+	def adjust_quality_all(newquals,phreds,i,z):
+		newprob= adjustment_model[i]+adjustment_model[z] + phred2prob(phreds[i])
+		#newprob=min(newprob,1.0)
+		newphred=int(prob2phred(newprob))
+		newquals[i]=newphred+33
+
+	def adjust_low_quality(real_read,newquals,phreds,phredsrev,readlen,a,b,i,z):
+		"""
+		make sure that quality is adjusted even if baseq is below threshold,
+		returns True when the CpG check ends the read
+		"""
+		if b == 'C' and a == 'T':
+			if cpg:
+				if i+1 >= readlen: return True
+				if real_read[i+1] != 'G': return False
+			adjust_quality(newquals,i,phreds,i)
+
+		if b == 'G' and a == 'A':
+			if cpg:
+				if i+1 >= readlen: return True
+				if real_read[z-1] != 'C': return False
+			adjust_quality(newquals,z,phredsrev,i)
+		return False
+
+	if deamination:
+		def score_read(real_read,real_ref_seq,quals,readlen):
+			"""
+			count the read bases at reference Cs (from the 5' end) and Gs (from the 3' end),
+			returns zero log likelihoods and the (possibly adjusted) base qualities
+			"""
+			newquals,phreds,phredsrev=prepare_quals(quals)
+			back_start_position = len(real_read)-1
+			for a,b,i in zip(real_read,real_ref_seq,range(0,len(real_ref_seq))):
+				if 'N' in [a,b]: continue
+				z = back_start_position - i # so real_read[::-1][i+1] is real_read[z-1], and real_read[::-1][z+1] is real_read[i-1]
+				if i >= readlen: break ###20
+
+				if adjustbaseq_all:
+					adjust_quality_all(newquals,phreds,i,z)
+
+				if phreds[i] < baseq:
+					if adjustbaseq and adjust_low_quality(real_read,newquals,phreds,phredsrev,readlen,a,b,i,z): break
+					continue
+
+				if b == 'C':
+					if cpg:
+						if i+1 >= readlen: break
+						if real_read[i+1] != 'G': continue
+					
+					if i < maxrange and a in BASE_INDEX:
+						counts[i][BASE_INDEX[a]] += 1
+					
+
+				if b == 'G':
+					if cpg:
+						if i+1 >= readlen: break
+						elif [z+1] >= readlen: break
+						if real_read[i-1] != 'C': continue
+					
+					if z < maxrange and a in BASE_INDEX:
+						counts_rev[z][BASE_INDEX[a]] += 1
+
+			return 0.0,0.0,newquals
+
+		return score_read
+
+	if pmdkernels is not None and not adjustbaseq and not adjustbaseq_all:
+		score=pmdkernels.Scorer(ancient_model,PHRED2PROB_DIV3,MODERN_DEAM,poly_ancient,poly_contamination,baseq,cpg).score
+		def score_read(real_read,real_ref_seq,quals,readlen):
+			"""
+			compute the log likelihoods of the read with the compiled kernel,
+			returns log(L_D), log(L_M) and the unchanged base qualities
+			"""
+			log_L_D,log_L_M=score(real_read,real_ref_seq,quals,readlen)
+			return log_L_D,log_L_M,quals
+
+		return score_read
+
+	def score_read(real_read,real_ref_seq,quals,readlen):
+		"""
+		compute the log likelihoods of the read under the PMD (L_D) and the no-PMD (L_M) models,
+		summed per base so that long reads do not underflow,
+		returns log(L_D), log(L_M) and the (possibly adjusted) base qualities
+		"""
+		log_L_D=0.0
+		log_L_M=0.0
+
+		newquals,phreds,phredsrev=prepare_quals(quals)
+		back_start_position = len(real_read)-1
+		for a,b,i in zip(real_read,real_ref_seq,range(0,len(real_ref_seq))):
+			if 'N' in [a,b]: continue
+			z = back_start_position - i # so real_read[::-1][i+1] is real_read[z-1]
+			if i >= readlen: break ###20
+
+			if adjustbaseq_all:
+				adjust_quality_all(newquals,phreds,i,z)
+
+			if phreds[i] < baseq:
+				if adjustbaseq and adjust_low_quality(real_read,newquals,phreds,phredsrev,readlen,a,b,i,z): break
+				continue
+
+
+			"""	
+			compute degradation score
+			"""
+			if b == 'C':
+				if cpg:
+					if i+1 >= readlen: break
+					if real_read[i+1] != 'G': continue
+				if a=='T': 
+					log_L_D += log(L_mismatch(i,ancient_model,phreds,poly_ancient))
+					log_L_M += log(L_mismatch_modern(phreds[i],poly_contamination))
+				
+					if adjustbaseq:
+						adjust_quality(newquals,i,phreds,i)
+					
+
+				
+
+				elif a=='C': 
+					log_L_D += log(L_match(i,ancient_model,phreds,poly_ancient))
+					log_L_M += log(L_match_modern(phreds[i],poly_contamination))
+
+			if b == 'G':
+				if cpg:
+					if i+1 >= readlen: break
+					if real_read[z-1] != 'C': continue
+				if a=='A': 
+					log_L_D += log(L_mismatch(z,ancient_model,phredsrev,poly_ancient))
+					log_L_M += log(L_mismatch_modern(phredsrev[z],poly_contamination))
+
+					if adjustbaseq:
+						adjust_quality(newquals,z,phredsrev,i)
+
+				elif a=='G': 
+					#try:
+					log_L_D += log(L_match(z,ancient_model,phredsrev,poly_ancient))
+					log_L_M += log(L_match_modern(phredsrev[z],poly_contamination))
+					#except IndexError:
+					#	print >>sys.stderr, line
+
+		return log_L_D,log_L_M,newquals
+
+	return score_read
+
+score_read = make_scorer(options.deamination,options.cpg,options.adjustbaseq,options.adjustbaseq_all,options.baseq,ancient_model_deam,adjustment_model_deam,options.polymorphism_ancient,options.polymorphism_contamination,options.range,mismatch_counts,mismatch_counts_rev)
+
+
+###SAM records are passed through as raw lines, always ending in a newline,
+###and all per-read output is collected and written to stdout in batches
+write = sys.stdout.write
+outbatch = []
+emit = outbatch.append
+OUTBATCH_SIZE = 1024
+
 line_counter = 0
 for line in sys.stdin: 
-	if '@' in line[0]: 
+	if len(outbatch) >= OUTBATCH_SIZE:
+		write(''.join(outbatch))
+		del outbatch[:]
+	if line[-1] != '\n':
+		line += '\n'
+	if line[0] == '@': 
 		if options.header:
-			print line.rstrip('\n')
+			emit(line)
 		continue
 	line_counter +=1
 
-	col = line.split('\t')
+	col = line[:-1].split('\t')
 	readname = col[0]
 	position = int(col[3])
 	chromosome = col[2]
@@ -186,6 +394,7 @@ for line in sys.stdin:
 	if len(quals) <2:
 		noquals+=1
 		continue
+	quals = bytearray(quals)
 
 	if options.noinsertions:
 		if 'I' in cigar:continue 
@@ -216,24 +425,28 @@ for line in sys.stdin:
 
 
 
-	if flag.isdigit():
-		if int(flag) & 16:
-			reverse = True
-		else:
-			reverse = False
-	else:
-		if 'r' in flag: reverse = True
-		elif 'r' not in flag: reverse = False
+	try:
+		reverse = bool(int(flag) & 16)
+	except ValueError:
+		# flags written as text by old versions of samtools
+		reverse = 'r' in flag
 
 	if options.notreverse:
 		if reverse: continue
 
+	# find the MD and DS fields in a single pass over the optional fields
+	MD=None
 	DSfield=False
-	if 'DS:Z:' in line:
-		DSfield=True
-		PMDS= float(line.split('DS:Z:')[1].rstrip('\n').split()[0])
-		LR=PMDS
-		#print PMDS
+	for tagindex in xrange(11,len(col)):
+		tag=col[tagindex]
+		if tag[:5] == 'MD:Z:':
+			MD=tag[5:].rstrip()
+		elif tag[:5] == 'DS:Z:' and DSfield == False:
+			DSfield=True
+			DSindex=tagindex
+			PMDS= float(tag[5:])
+			LR=PMDS
+			#print PMDS
 	
 
 
@@ -244,77 +457,65 @@ for line in sys.stdin:
 	if (DSfield == False) or (options.writesamfield) or (options.basic > 0) or (options.perc_identity > 0.01) or (options.printalignments) or (options.adjustbaseq) or (options.adjustbaseq_all) or options.deamination or options.dry:
 		
 		read=col[9]
-		ref_seq=''
-		newread=''
 	
 		import re
-		try:
-			MD=line.split('MD:Z:')[1].split()[0].rstrip('\n')
-		except IndexError:
+		if MD is None:
 			noMD+=1
 			continue
 
 		MDlist=re.findall('(\d+|\D+)',MD)
 
-			
+		# the reference is the read with the mismatching bases from the MD field filled in,
+		# mismatches maps alignment columns (deleted bases included) to their reference base
+		ref_seq=bytearray(read)
+		mismatches={}
 		MDcounter=0
-		alignment=''
+		alignmentlength=0
 		for e in MDlist:
 			if e.isdigit():
 				e=int(e)
-				alignment += '.'*e
-				ref_seq+= read[MDcounter:MDcounter+e]
-				newread+= read[MDcounter:MDcounter+e]
-				MDcounter+= int(e)
+				MDcounter+= e
+				alignmentlength+= e
 
 			elif '^' in e:
 				ef=e.lstrip('^')
-				alignment += ef
+				for refbase in ef:
+					mismatches[alignmentlength]=ord(refbase)
+					alignmentlength+=1
 				continue
 			elif e.isalpha():
-				alignment += e
-				ref_seq+= e
-				newread+= read[MDcounter]
+				ref_seq[MDcounter:MDcounter+len(e)]=e
+				for refbase in e:
+					mismatches[alignmentlength]=ord(refbase)
+					alignmentlength+=1
 				MDcounter+=len(e)
+		del ref_seq[MDcounter:]
 
 		if 'I' in cigar or 'S' in cigar:
 
-			# find insertions and clips in cigar
-			insertions=[]
-			deletions=[]
-			softclips=[]
-			hardclips=[]
-			paddings=[]
+			# find insertions and clips in cigar, marking the cigar operation of each read position
+			cigarmask=bytearray(readlen)
 			cigarcount=0
-			cigarcomponents=cigarparser.findall(cigar)
-			for p in cigarcomponents:
-				cigaraddition=int(p[0])
-				if 'I' in p[1]: 
-					for c in range(cigarcount,cigarcount+cigaraddition): insertions.append(c)
-				elif  'S' in p[1]:
-					for c in range(cigarcount,cigarcount+cigaraddition): softclips.append(c)
-				cigarcount += int(p[0])
+			for cigaraddition,cigarop in parse_cigar(cigar):
+				if cigarop == 'I' or cigarop == 'S':
+					cigarmask[cigarcount:cigarcount+cigaraddition] = cigarop*cigaraddition
+				cigarcount += cigaraddition
 			# end cigar parsing
 
-			# redo the read and ref using indel and clip info
-			ref_seq=''
-			newread =''
+			# redo the ref using indel and clip info
+			ref_seq=bytearray(read)
 			alignmentcounter=0
-			for x,r in zip(xrange(0,len(col[9])),read):
-				if x in insertions:
-					ref_seq += '-'
-					newread += read[x]
-				elif x in softclips:
-					ref_seq += '-'
-					newread += read[x]
+			for x in xrange(0,len(col[9])):
+				cigarop=cigarmask[x]
+				if cigarop == 73: # I
+					ref_seq[x] = 45 # -
+				elif cigarop == 83: # S
+					ref_seq[x] = 45 # -
 				else:
-					newread += read[x]
-					refbasealn=alignment[alignmentcounter]
-					if refbasealn == '.':
-						ref_seq += read[x]
-					else:
-						ref_seq += refbasealn
+					if alignmentcounter in mismatches:
+						ref_seq[x] = mismatches[alignmentcounter]
 					alignmentcounter +=1
+		ref_seq=str(ref_seq)
 					
 		if reverse:
 			read = revcomp(read)
@@ -338,8 +539,8 @@ for line in sys.stdin:
 			if i >= readlen: break ###20
 			if i > options.basic: break
 			#print a,b,i
-			if b == 'C' and a=='T' and ((ord(quals[i])-33) > options.baseq): 
-				print line.rstrip('\n')
+			if b == 'C' and a=='T' and ((quals[i]-33) > options.baseq): 
+				emit(line)
 				break
 
 		continue
@@ -383,146 +584,16 @@ for line in sys.stdin:
 	"""
 
 	if (DSfield == False) or (DSfield == True and options.writesamfield == True) or (options.basic > 0) or options.adjustbaseq or options.adjustbaseq_all or options.deamination or options.dry:
-		L_D=1.0
-		L_M=1.0
-
-		newquals=quals
-		start_position = 0
-		back_start_position = len(real_read)-1
-		for a,b,x in zip(real_read,real_ref_seq,range(0,len(real_ref_seq))):
-			if 'N' in [a,b]: continue
-			i = x - start_position
-			z = back_start_position - x 
-			qualsrev=quals[::-1]
-			if i >= readlen: break ###20
-
-			if options.adjustbaseq_all:
-				newprob= adjustment_model_deam[i]+adjustment_model_deam[z] + phred2prob(ord(quals[i])-33)
-				#newprob=min(newprob,1.0)
-				newphred=int(prob2phred(newprob))
-				newqual=chr(int(newphred)+33)						
-				newquals=quals[0:i]+newqual+quals[(i+1):]
-
-			if (ord(quals[i])-33) < options.baseq:
-				#make sure that quality is adjusted even if baseq is below threshold
-				if options.adjustbaseq:
-					if b == 'C' and a == 'T':
-						if options.cpg:
-							if i+1 >= readlen: break
-							if real_read[i+1] != 'G': continue
-
-						newprob= Newbaseq(i,ancient_model_deam,quals)
-						newphred=int(prob2phred(newprob))
-						newqual=chr(int(newphred)+33)						
-						newquals=quals[0:i]+newqual+quals[(i+1):]
-
-					if b == 'G' and a == 'A':
-						if options.cpg:
-							if i+1 >= readlen: break
-							if real_read[::-1][i+1] != 'C': continue
-
-						newprob= Newbaseq(z,ancient_model_deam,qualsrev)
-						newphred=int(prob2phred(newprob))
-						newqual=chr(int(newphred)+33)						
-						newquals=quals[0:i]+newqual+quals[(i+1):]
-				continue
-
-			if options.deamination:
-				if b == 'C':
-					if options.cpg:
-						if i+1 >= readlen: break
-						if real_read[i+1] != 'G': continue
-					
-					thekey=b+a+str(i)
-					if thekey in mismatch_dict.keys():
-						addition = mismatch_dict[thekey]
-						addition += 1
-						mismatch_dict[thekey] = addition
-					else:
-						mismatch_dict[thekey] = 1
-					
-
-				if b == 'G':
-					if options.cpg:
-						if i+1 >= readlen: break
-						elif [z+1] >= readlen: break
-						if real_read[::-1][z+1] != 'C': continue
-					
-					thekey=b+a+str(z)
-					if thekey in mismatch_dict_rev.keys():
-						addition = mismatch_dict_rev[thekey]
-						addition += 1
-						mismatch_dict_rev[thekey] = addition
-					else:
-						mismatch_dict_rev[thekey] = 1
-				continue
-
-
-			"""	
-			compute degradation score
-			"""
-			if True:
-				if i >= readlen:continue
-				if b == 'C':
-					if options.cpg:
-						if i+1 >= readlen: break
-						if real_read[i+1] != 'G': continue
-					if a=='T': 
-						L_D = L_D * L_mismatch(i,ancient_model_deam,quals,options.polymorphism_ancient) 
-						L_M = L_M * L_mismatch(i,modern_model_deam,quals,options.polymorphism_contamination) 
-					
-						if options.adjustbaseq:
-							newprob= Newbaseq(i,ancient_model_deam,quals)
-							newphred=int(prob2phred(newprob))
-							newqual=chr(int(newphred)+33)
-							"""
-							print phred2prob(ord(quals[i])),newprob
-							print ord(quals[i]),newphred
-							print quals[i],newqual
-							print quals[0:i],quals[i],quals[(i+1):]
-							print quals	
-							"""					
-							quals=quals[0:i]+newqual+quals[(i+1):]
-						
-
-					
-
-					elif a=='C': 
-						L_D = L_D * L_match(i,ancient_model_deam,quals,options.polymorphism_ancient) 
-						L_M = L_M * L_match(i,modern_model_deam,quals,options.polymorphism_contamination) 
-
-				if b == 'G':
-					if options.cpg:
-						if i+1 >= readlen: break
-						if real_read[::-1][i+1] != 'C': continue
-					if a=='A': 
-						L_D = L_D * L_mismatch(z,ancient_model_deam,qualsrev,options.polymorphism_ancient) 
-						L_M = L_M * L_mismatch(z,modern_model_deam,qualsrev,options.polymorphism_contamination) 
-
-						if options.adjustbaseq:
-							newprob= Newbaseq(z,ancient_model_deam,qualsrev)
-							
-							newphred=int(prob2phred(newprob))
-							newqual=chr(int(newphred)+33)						
-							newquals=quals[0:i]+newqual+quals[(i+1):]
-
-					elif a=='G': 
-						#try:
-						L_D = L_D * L_match(z,ancient_model_deam,qualsrev,options.polymorphism_ancient) 
-						L_M = L_M * L_match(z,modern_model_deam,qualsrev,options.polymorphism_contamination) 
-						#except IndexError:
-						#	print >>sys.stderr, line
-
-
-		LR= (math.log(L_D/L_M)  )
-		quals=newquals	
+		log_L_D,log_L_M,quals = score_read(real_read,real_ref_seq,quals,readlen)
+		LR= log_L_D - log_L_M
 
 	if options.adjustbaseq:
 		if reverse:
 			qualsp=quals[::-1]
 		else:
 			qualsp=quals
-		line='\t'.join(col[0:10])+'\t'+qualsp+'\t'+'\t'.join(col[11:])
+		col[10]=str(qualsp)
+		line='\t'.join(col)+'\n'
 
 	"""
 	add PMDS tag
@@ -530,28 +601,23 @@ for line in sys.stdin:
 	if options.writesamfield == True:
 		# remove DS field if present
 		if DSfield==True:
-			newline=''
-			for col in line.split('\t'):
-				if 'DS:Z:' in col:
-					continue
-				else:
-					newline += col+'\t'
-			line=newline.rstrip('\t')
+			del col[DSindex]
 		
-		line=line.rstrip('\n')+'\t'+'DS:Z:'+str(round(LR,3))
+		col.append('DS:Z:'+str(round(LR,3)))
+		line='\t'.join(col)+'\n'
 
 
 	if options.printDS:
-		print L_D,'\t',L_M,'\t',L_D/L_M,'\t',LR#,'\t',readlen,'\t',perc_identity,'\t',perc_identity*(math.log((L_D/L_M)))
+		emit('%s \t%s \t%s \t%s\n' % (math.exp(log_L_D),math.exp(log_L_M),math.exp(log_L_D-log_L_M),LR))#,'\t',readlen,'\t',perc_identity,'\t',perc_identity*(math.log((L_D/L_M)))
 
 	if options.dry:
-		print line.rstrip('\n')
+		emit(line)
 		continue
 	
 	if options.threshold > (-10000) or options.upperthreshold < (1000000): 
 
 		if LR >= options.threshold and LR < options.upperthreshold:
-			print line.rstrip('\n')
+			emit(line)
 		else:
 			excluded_threshold +=1
 
@@ -560,7 +626,7 @@ for line in sys.stdin:
 	if options.printalignments:
 		if options.threshold > (-10000) or options.upperthreshold < (1000000):
 			try:
-				LR= (math.log(L_D/L_M)  )
+				LR= log_L_D - log_L_M
 			except: continue
 			if LR < options.threshold or LR >options.upperthreshold < (1000000):
 				continue
@@ -568,7 +634,7 @@ for line in sys.stdin:
 		quals1=''
 		quals2=''			
 		for q in quals:
-			qnum=ord(q)-33
+			qnum=q-33
 			if qnum <10:
 				quals1 +='0'
 				quals2+=str(qnum)
@@ -577,16 +643,17 @@ for line in sys.stdin:
 				quals2+=str(qnum)[1]
 		#print MD,cigar,reverse
 		#print col[9]
-		print real_read
-		print mismatch_string
-		print real_ref_seq
-		print quals
+		emit(real_read+'\n')
+		emit(mismatch_string+'\n')
+		emit(real_ref_seq+'\n')
+		emit(str(quals)+'\n')
 		#print quals1
 		#print quals2
 		#print col[10]
-		print ''
+		emit('\n')
 	passed+=1
 	if passed >= options.maxreads:break
+write(''.join(outbatch))
 
 
 if options.stats:
@@ -602,48 +669,25 @@ if options.stats:
 
 
 if options.deamination:
-	if True:
-		pairs=['CT','CA','CG','CC','GA','GT','GC','GG']
-		itotaldict={}
-		ztotaldict={}
-		for i in range(0,options.range):
-			itotal=0
-			ztotal=0
-			for p in pairs:
-				thekey=p+str(i)
-				try:
-					itotal += mismatch_dict[thekey]
-				except KeyError: pass
-				try:
-					ztotal += mismatch_dict_rev[thekey]
-				except KeyError: pass
-			itotaldict[i]=itotal
-			ztotaldict[i]=ztotal
-
-		print 'z\t','\t'.join(pairs)
-
-		for i in range(0,options.range):
-			print str(i)+'\t',
-			for p in pairs:
-				thekey=p+str(i)
-				if 'C' in p[0]:
-					try:
-						thecount=mismatch_dict[thekey]
-					except KeyError: 
-						print '0.00000\t',
-						continue
-					thetotal=itotaldict[i]
-					frac=1.0*thecount/thetotal
-				if 'G' in p[0]:
-					try:
-						thecount=mismatch_dict_rev[thekey]
-					except KeyError: 
-						print '0.00000\t',
-						continue
-					thetotal=ztotaldict[i]
-					frac=1.0*thecount/thetotal
-				print str(round(frac,5))+'\t',
-			print ''
+	pairs=['CT','CA','CG','CC','GA','GT','GC','GG']
+
+	print 'z\t','\t'.join(pairs)
+
+	for i in range(0,options.range):
+		print str(i)+'\t',
+		for p in pairs:
+			if 'C' in p[0]:
+				thecount=mismatch_counts[i][BASE_INDEX[p[1]]]
+				thetotal=sum(mismatch_counts[i])
+			if 'G' in p[0]:
+				thecount=mismatch_counts_rev[i][BASE_INDEX[p[1]]]
+				thetotal=sum(mismatch_counts_rev[i])
+			if thecount == 0:
+				print '0.00000\t',
+				continue
+			frac=1.0*thecount/thetotal
+			print str(round(frac,5))+'\t',
+		print ''
 
 
 